@@ -1,16 +1,48 @@
 """Fetches extensions and publishers from the VSCode Marketplace"""
 
-import time
 from logging import Logger
 from typing import Tuple
 from datetime import datetime
 import uuid
-import requests
+import orjson
 import pandas as pd
-from dateutil import parser
 import psycopg2
 
-from util import upsert_data, clean_dataframe, connect_to_database
+from util import (
+    query_extensions,
+    upsert_data,
+    clean_dataframe,
+    parse_datetime_columns,
+    connect_to_database,
+    release_connection,
+    map_marketplace_requests,
+)
+
+# Marketplace statistics recorded for each extension
+EXTENSION_STATISTIC_NAMES = (
+    "install",
+    "averagerating",
+    "ratingcount",
+    "trendingdaily",
+    "trendingmonthly",
+    "trendingweekly",
+    "updateCount",
+    "weightedRating",
+    "downloadCount",
+)
+
+# Extension property holding the link to the extension's GitHub repository
+GITHUB_LINK_PROPERTY_KEY = "Microsoft.VisualStudio.Services.Links.GitHub"
+
+# Marketplace publisher fields and the publishers table columns they are stored in
+PUBLISHER_COLUMNS = {
+    "publisherId": "publisher_id",
+    "publisherName": "publisher_name",
+    "displayName": "display_name",
+    "flags": "flags",
+    "domain": "domain",
+    "isDomainVerified": "is_domain_verified",
+}
 
 
 def get_total_number_of_extensions(logger: Logger) -> int:
@@ -36,14 +68,9 @@ def get_total_number_of_extensions(logger: Logger) -> int:
         "flags": 0x100,  # Include statistics
     }
 
-    response = requests.post(
-        "https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery",
-        headers={"accept": "application/json;api-version=7.2-preview.1;"},
-        json=payload,
-        timeout=5,
-    )
+    response = query_extensions(payload)
     if response.status_code == 200:
-        result_metadata = response.json()["results"][0]["resultMetadata"]
+        result_metadata = orjson.loads(response.content)["results"][0]["resultMetadata"]
 
         total_count = None
         for metadata in result_metadata:
@@ -73,7 +100,7 @@ def calculate_number_of_extension_pages(
 ) -> int:
     """Calculates the number of extension pages to fetch"""
 
-    return num_extensions // extensions_page_size + 1
+    return max(1, -(-num_extensions // extensions_page_size))
 
 
 def get_extensions(
@@ -105,15 +132,10 @@ def get_extensions(
         "flags": 0x100,  # Include statistics
     }
 
-    response = requests.post(
-        "https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery",
-        headers={"accept": "application/json;api-version=7.2-preview.1;"},
-        json=payload,
-        timeout=5,
-    )
+    response = query_extensions(payload)
 
     if response.status_code == 200:
-        extensions = response.json()["results"][0]["extensions"]
+        extensions = orjson.loads(response.content)["results"][0]["extensions"]
         logger.info(
             "get_extensions: Fetched %d extensions from page number %d",
             len(extensions),
@@ -133,14 +155,20 @@ def get_extensions(
 def get_all_extensions(
     logger: Logger,
     last_page_number: int,
+    max_workers: int = 8,
 ) -> list:
     """Fetches all extension metadata from the VSCode Marketplace"""
 
+    pages = map_marketplace_requests(
+        logger,
+        get_extensions,
+        range(1, last_page_number + 1),
+        max_workers=max_workers,
+    )
+
     all_extensions = []
 
-    for page_number in range(1, last_page_number + 1):
-        time.sleep(1)
-        extensions = get_extensions(logger, page_number)
+    for page_number, extensions in enumerate(pages, start=1):
         if extensions is None:
             logger.error(
                 "get_all_extensions: Failed to get extensions on page number %d",
@@ -153,28 +181,24 @@ def get_all_extensions(
     return all_extensions
 
 
-def extract_extension_metadata(extensions: list) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    """Extracts relevant extension information from the raw data"""
+def extract_metadata(
+    extensions: list,
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Extracts relevant extension, statistics and publisher information from the raw data"""
 
-    unique_extensions = set()
     extensions_metadata = []
     statistics_metadata = []
+    publishers_metadata = []
 
     for extension in extensions:
         extension_id = extension["extensionId"]
-        if extension_id in unique_extensions:
-            continue
-        unique_extensions.add(extension_id)
-
         extension_name = extension["extensionName"]
         publisher_name = extension["publisher"]["publisherName"]
         extension_identifier = publisher_name + "." + extension_name
 
         latest_version = extension["versions"][0]
-        properties = latest_version.get("properties", {})
-        github_url = extract_extension_github_url(properties)
-        extension_statistics = extension.get("statistics", {})
-        statistics = extract_extension_statistics(extension_statistics)
+        github_url = extract_extension_github_url(latest_version.get("properties", {}))
+        statistics = extract_extension_statistics(extension.get("statistics", {}))
 
         extensions_metadata.append(
             {
@@ -182,9 +206,9 @@ def extract_extension_metadata(extensions: list) -> Tuple[pd.DataFrame, pd.DataF
                 "extension_name": extension["extensionName"],
                 "display_name": extension["displayName"],
                 "flags": extension["flags"],
-                "last_updated": parser.isoparse(extension["lastUpdated"]),
-                "published_date": parser.isoparse(extension["publishedDate"]),
-                "release_date": parser.isoparse(extension["releaseDate"]),
+                "last_updated": extension["lastUpdated"],
+                "published_date": extension["publishedDate"],
+                "release_date": extension["releaseDate"],
                 "short_description": extension.get("shortDescription", ""),
                 "latest_release_version": latest_version["version"],
                 "latest_release_asset_uri": latest_version["assetUri"],
@@ -209,71 +233,84 @@ def extract_extension_metadata(extensions: list) -> Tuple[pd.DataFrame, pd.DataF
             }
         )
 
-    return pd.DataFrame(extensions_metadata), pd.DataFrame(statistics_metadata)
-
-
-def extract_publisher_metadata(extensions: list) -> pd.DataFrame:
-    """Extracts relevant publisher information from the raw data"""
+        publishers_metadata.append(extension["publisher"])
+
+    # Deduplicate extension data, keeping the first occurrence of each extension
+    extensions_df = pd.DataFrame(
+        extensions_metadata,
+        columns=[
+            "extension_id",
+            "extension_name",
+            "display_name",
+            "flags",
+            "last_updated",
+            "published_date",
+            "release_date",
+            "short_description",
+            "latest_release_version",
+            "latest_release_asset_uri",
+            "publisher_id",
+            "extension_identifier",
+            "github_url",
+        ],
+    ).drop_duplicates("extension_id")
+    extensions_df = parse_datetime_columns(
+        extensions_df, ["last_updated", "published_date", "release_date"]
+    )
+    statistics_df = pd.DataFrame(
+        statistics_metadata,
+        columns=[
+            "extension_id",
+            "install",
+            "average_rating",
+            "rating_count",
+            "trending_daily",
+            "trending_monthly",
+            "trending_weekly",
+            "update_count",
+            "weighted_rating",
+            "download_count",
+        ],
+    ).drop_duplicates("extension_id")
 
-    publishers_metadata = []
-    unique_publishers = set()
+    return (
+        extensions_df.reset_index(drop=True),
+        statistics_df.reset_index(drop=True),
+        extract_publisher_metadata(publishers_metadata),
+    )
 
-    for extension in extensions:
-        publisher_metadata = extension["publisher"]
-        publisher_id = publisher_metadata["publisherId"]
 
-        # Deduplicate publisher data
-        if publisher_id in unique_publishers:
-            continue
-        unique_publishers.add(publisher_id)
+def extract_publisher_metadata(publishers: list) -> pd.DataFrame:
+    """Extracts relevant publisher information from the raw publisher data"""
 
-        publishers_metadata.append(
-            {
-                "publisher_id": publisher_id,
-                "publisher_name": publisher_metadata["publisherName"],
-                "display_name": publisher_metadata["displayName"],
-                "flags": publisher_metadata["flags"],
-                "domain": publisher_metadata["domain"],
-                "is_domain_verified": publisher_metadata["isDomainVerified"],
-            }
-        )
+    publishers_df = pd.DataFrame(publishers, columns=list(PUBLISHER_COLUMNS))
 
-    return pd.DataFrame(publishers_metadata)
+    # Deduplicate publisher data
+    return (
+        publishers_df.drop_duplicates("publisherId")
+        .rename(columns=PUBLISHER_COLUMNS)
+        .reset_index(drop=True)
+    )
 
 
 def extract_extension_statistics(statistics: list) -> dict:
     """Finds the extension statistics"""
 
-    extension_stats = {
-        "install": 0,
-        "averagerating": 0,
-        "ratingcount": 0,
-        "trendingdaily": 0,
-        "trendingmonthly": 0,
-        "trendingweekly": 0,
-        "updateCount": 0,
-        "weightedRating": 0,
-        "downloadCount": 0,
-    }
-
-    for stat in statistics:
-        name = stat["statisticName"]
-        value = stat["value"]
-        if name in extension_stats:
-            extension_stats[name] = value
-
-    return extension_stats
+    values = {stat["statisticName"]: stat["value"] for stat in statistics}
+    return {name: values.get(name, 0) for name in EXTENSION_STATISTIC_NAMES}
 
 
 def extract_extension_github_url(properties: list) -> str:
     """Finds the GitHub URL of the extension"""
 
-    github_url = ""
-    for extension_property in properties:
-        if extension_property["key"] == "Microsoft.VisualStudio.Services.Links.GitHub":
-            github_url = extension_property["value"]
-            break
-    return github_url
+    return next(
+        (
+            extension_property["value"]
+            for extension_property in properties
+            if extension_property["key"] == GITHUB_LINK_PROPERTY_KEY
+        ),
+        "",
+    )
 
 
 def upsert_extensions(
@@ -284,51 +321,39 @@ def upsert_extensions(
 ) -> None:
     """Upserts the given extensions to the database in batches"""
 
-    upsert_query = """
-        INSERT INTO extensions (
-            extension_id, extension_name, display_name, flags, last_updated, published_date, release_date, 
-            short_description, latest_release_version, latest_release_asset_uri, publisher_id, 
-            extension_identifier, github_url, insertion_datetime
-        ) VALUES %s
-        ON CONFLICT (extension_id) DO UPDATE SET
-            extension_name = EXCLUDED.extension_name,
-            display_name = EXCLUDED.display_name,
-            flags = EXCLUDED.flags,
-            last_updated = EXCLUDED.last_updated,
-            published_date = EXCLUDED.published_date,
-            release_date = EXCLUDED.release_date,
-            short_description = EXCLUDED.short_description,
-            latest_release_version = EXCLUDED.latest_release_version,
-            latest_release_asset_uri = EXCLUDED.latest_release_asset_uri,
-            publisher_id = EXCLUDED.publisher_id,
-            extension_identifier = EXCLUDED.extension_identifier,
-            github_url = EXCLUDED.github_url,
-            insertion_datetime = EXCLUDED.insertion_datetime;
-    """
+    columns = [
+        "extension_id",
+        "extension_name",
+        "display_name",
+        "flags",
+        "last_updated",
+        "published_date",
+        "release_date",
+        "short_description",
+        "latest_release_version",
+        "latest_release_asset_uri",
+        "publisher_id",
+        "extension_identifier",
+        "github_url",
+        "insertion_datetime",
+    ]
 
+    insertion_datetime = datetime.now()
     values = [
-        (
-            row["extension_id"],
-            row["extension_name"],
-            row["display_name"],
-            row["flags"],
-            row["last_updated"],
-            row["published_date"],
-            row["release_date"],
-            row["short_description"],
-            row["latest_release_version"],
-            row["latest_release_asset_uri"],
-            row["publisher_id"],
-            row["extension_identifier"],
-            row["github_url"],
-            datetime.now(),
-        )
-        for _, row in extensions_df.iterrows()
+        (*row, insertion_datetime)
+        for row in extensions_df[columns[:-1]].itertuples(index=False, name=None)
     ]
 
     for i in range(0, len(values), batch_size):
         batch = values[i : i + batch_size]
-        upsert_data(logger, connection, "extensions", upsert_query, batch)
+        upsert_data(
+            logger,
+            connection,
+            "extensions",
+            columns,
+            batch,
+            conflict_column="extension_id",
+        )
         logger.info(
             "upsert_extensions: Upserted extensions batch %d of %d rows",
             i // batch_size + 1,
@@ -344,35 +369,32 @@ def upsert_publishers(
 ) -> None:
     """Upserts the given publishers to the database in batches"""
 
-    upsert_query = """
-        INSERT INTO publishers (
-            publisher_id, publisher_name, display_name, flags, domain, is_domain_verified, insertion_datetime
-        ) VALUES %s
-        ON CONFLICT (publisher_id) DO UPDATE SET
-            publisher_name = EXCLUDED.publisher_name,
-            display_name = EXCLUDED.display_name,
-            flags = EXCLUDED.flags,
-            domain = EXCLUDED.domain,
-            is_domain_verified = EXCLUDED.is_domain_verified,
-            insertion_datetime = EXCLUDED.insertion_datetime;
-    """
+    columns = [
+        "publisher_id",
+        "publisher_name",
+        "display_name",
+        "flags",
+        "domain",
+        "is_domain_verified",
+        "insertion_datetime",
+    ]
 
+    insertion_datetime = datetime.now()
     values = [
-        (
-            row["publisher_id"],
-            row["publisher_name"],
-            row["display_name"],
-            row["flags"],
-            row["domain"],
-            row["is_domain_verified"],
-            datetime.now(),
-        )
-        for _, row in publishers_df.iterrows()
+        (*row, insertion_datetime)
+        for row in publishers_df[columns[:-1]].itertuples(index=False, name=None)
     ]
 
     for i in range(0, len(values), batch_size):
         batch = values[i : i + batch_size]
-        upsert_data(logger, connection, "publishers", upsert_query, batch)
+        upsert_data(
+            logger,
+            connection,
+            "publishers",
+            columns,
+            batch,
+            conflict_column="publisher_id",
+        )
         logger.info(
             "upsert_publishers: Upserted publishers batch %d of %d rows",
             i // batch_size + 1,
@@ -388,46 +410,37 @@ def upsert_statistics(
 ) -> None:
     """Upserts the given statistics to the database in batches"""
 
-    upsert_query = """
-        INSERT INTO statistics (
-            statistic_id, extension_id, install, average_rating, rating_count, trending_daily,
-            trending_monthly, trending_weekly, update_count, weighted_rating, download_count, insertion_datetime
-        ) VALUES %s
-        ON CONFLICT (statistic_id) DO UPDATE SET
-            extension_id = EXCLUDED.extension_id,
-            install = EXCLUDED.install,
-            average_rating = EXCLUDED.average_rating,
-            rating_count = EXCLUDED.rating_count,
-            trending_daily = EXCLUDED.trending_daily,
-            trending_monthly = EXCLUDED.trending_monthly,
-            trending_weekly = EXCLUDED.trending_weekly,
-            update_count = EXCLUDED.update_count,
-            weighted_rating = EXCLUDED.weighted_rating,
-            download_count = EXCLUDED.download_count,
-            insertion_datetime = EXCLUDED.insertion_datetime;
-    """
+    columns = [
+        "statistic_id",
+        "extension_id",
+        "install",
+        "average_rating",
+        "rating_count",
+        "trending_daily",
+        "trending_monthly",
+        "trending_weekly",
+        "update_count",
+        "weighted_rating",
+        "download_count",
+        "insertion_datetime",
+    ]
 
+    insertion_datetime = datetime.now()
     values = [
-        (
-            str(uuid.uuid4()),
-            row["extension_id"],
-            row["install"],
-            row["average_rating"],
-            row["rating_count"],
-            row["trending_daily"],
-            row["trending_monthly"],
-            row["trending_weekly"],
-            row["update_count"],
-            row["weighted_rating"],
-            row["download_count"],
-            datetime.now(),
-        )
-        for _, row in statistics_df.iterrows()
+        (str(uuid.uuid4()), *row, insertion_datetime)
+        for row in statistics_df[columns[1:-1]].itertuples(index=False, name=None)
     ]
 
     for i in range(0, len(values), batch_size):
         batch = values[i : i + batch_size]
-        upsert_data(logger, connection, "statistics", upsert_query, batch)
+        upsert_data(
+            logger,
+            connection,
+            "statistics",
+            columns,
+            batch,
+            conflict_column="statistic_id",
+        )
         logger.info(
             "upsert_statistics: Upserted statistics batch %d of %d rows",
             i // batch_size + 1,
@@ -458,8 +471,7 @@ def fetch_extensions_and_publishers(logger: Logger) -> bool:
         )
         return False
 
-    extensions_df, statistics_df = extract_extension_metadata(extensions)
-    publishers_df = extract_publisher_metadata(extensions)
+    extensions_df, statistics_df, publishers_df = extract_metadata(extensions)
 
     # Upsert retrieved data to the database
     publishers_df = clean_dataframe(publishers_df)
@@ -477,6 +489,6 @@ def fetch_extensions_and_publishers(logger: Logger) -> bool:
     upsert_statistics(logger, connection, statistics_df)
 
     # Close
-    connection.close()
+    release_connection(connection)
 
     return True
@@ -1,18 +1,21 @@
 """Fetches extension releases from the VSCode Marketplace"""
 
-import time
 from logging import Logger
-import requests
+from datetime import datetime
+import orjson
 import pandas as pd
 import psycopg2
-from dateutil import parser
 
 from util import (
+    query_extensions,
     upsert_data,
     clean_dataframe,
+    parse_datetime_columns,
     connect_to_database,
+    release_connection,
     select_extensions,
     select_latest_releases,
+    map_marketplace_requests,
 )
 
 
@@ -41,15 +44,12 @@ def get_extension_releases(
         "flags": 0x1,  # Include versions
     }
 
-    response = requests.post(
-        "https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery",
-        headers={"accept": "application/json;api-version=7.2-preview.1;"},
-        json=json_data,
-        timeout=5,
-    )
+    response = query_extensions(json_data)
 
     if response.status_code == 200:
-        releases = response.json()["results"][0]["extensions"][0]["versions"]
+        releases = orjson.loads(response.content)["results"][0]["extensions"][0][
+            "versions"
+        ]
         logger.info(
             "get_extension_releases: Fetched extension releases for extension %s",
             extension_identifier,
@@ -70,82 +70,64 @@ def get_all_releases(
     logger: Logger,
     extensions_df: pd.DataFrame,
     releases_df: pd.DataFrame,
+    max_workers: int = 16,
 ) -> dict:
     """Fetches all release metadata from the VSCode Marketplace"""
 
-    all_releases = {}
-    extension_data = list(
-        zip(
-            extensions_df["extension_id"],
-            extensions_df["extension_identifier"],
-            extensions_df["latest_release_version"],
-        )
+    # Compare each extension's latest version with the latest release already stored
+    merged_df = extensions_df.merge(
+        releases_df[["extension_id", "version"]], on="extension_id", how="left"
     )
+    is_fetched = merged_df["latest_release_version"] == merged_df["version"]
+    logger.info(
+        "get_all_releases: Skipped fetching the releases for %d extensions "
+        "since they have already been retrieved",
+        is_fetched.sum(),
+    )
+    pending_df = merged_df.loc[~is_fetched, ["extension_id", "extension_identifier"]]
 
-    for extension_id, extension_identifier, extensions_latest_version in extension_data:
-        releases_latest_version = releases_df[
-            releases_df["extension_id"] == extension_id
-        ]["version"]
-
-        # Check if the latest release has already been fetched for the extension in a previous run
-        if (
-            not releases_latest_version.empty
-            and extensions_latest_version == releases_latest_version.iloc[0]
-        ):
-            logger.info(
-                "get_all_releases: Skipped fetching the releases for %s "
-                "since they have already been retrieved",
-                extension_identifier,
-            )
-            continue
-
-        time.sleep(1)
-
-        releases = get_extension_releases(logger, extension_identifier)
-        all_releases[extension_id] = releases
+    releases = map_marketplace_requests(
+        logger,
+        get_extension_releases,
+        pending_df["extension_identifier"],
+        max_workers=max_workers,
+    )
 
-    return all_releases
+    return dict(zip(pending_df["extension_id"], releases))
 
 
 def extract_release_metadata(logger: Logger, releases: list) -> pd.DataFrame:
     """Extracts the relevant release information from the raw data"""
 
-    release_metadata = []
-    release_ids = set()
-
-    for extension_id in releases:
-        extension_releases = releases[extension_id]
-
-        for extension_release in extension_releases:
-            extension_version = extension_release["version"]
-            release_id = extension_id + "-" + extension_version
-
-            # Deduplicate release data
-            # This shouldn't be necessary but the release ID is not always unique
-            if release_id in release_ids:
-                logger.info(
-                    "extract_release_metadata: Duplicate extension release found "
-                    "with release ID %s",
-                    release_id,
-                )
-                continue
-            release_ids.add(release_id)
-
-            release_metadata.append(
-                {
-                    "release_id": release_id,
-                    "version": extension_version,
-                    "flags": extension_release["flags"],
-                    "last_updated": parser.isoparse(extension_release["lastUpdated"]),
-                    "extension_id": extension_id,
-                }
-            )
-
-    return pd.DataFrame(
+    release_metadata = [
+        {
+            "release_id": extension_id + "-" + extension_release["version"],
+            "version": extension_release["version"],
+            "flags": extension_release["flags"],
+            "last_updated": extension_release["lastUpdated"],
+            "extension_id": extension_id,
+        }
+        for extension_id, extension_releases in releases.items()
+        for extension_release in extension_releases
+    ]
+
+    releases_df = pd.DataFrame(
         release_metadata,
         columns=["release_id", "version", "extension_id", "flags", "last_updated"],
     )
 
+    # Deduplicate release data, keeping the first occurrence of each release
+    # This shouldn't be necessary but the release ID is not always unique
+    num_duplicates = releases_df["release_id"].duplicated().sum()
+    if num_duplicates:
+        logger.info(
+            "extract_release_metadata: Found %d duplicate extension releases",
+            num_duplicates,
+        )
+        releases_df = releases_df.drop_duplicates("release_id").reset_index(drop=True)
+
+    return parse_datetime_columns(releases_df, ["last_updated"])
+
 
 def upsert_releases(
     logger: Logger,
@@ -155,31 +137,26 @@ def upsert_releases(
 ) -> None:
     """Upserts the given releases to the database in batches"""
 
-    upsert_query = """
-        INSERT INTO releases (
-            release_id, version, extension_id, flags, last_updated
-        ) VALUES %s
-        ON CONFLICT (release_id) DO UPDATE SET
-            version = EXCLUDED.version,
-            extension_id = EXCLUDED.extension_id,
-            flags = EXCLUDED.flags,
-            last_updated = EXCLUDED.last_updated;
-    """
+    columns = [
+        "release_id",
+        "version",
+        "extension_id",
+        "flags",
+        "last_updated",
+        "insertion_datetime",
+    ]
 
+    insertion_datetime = datetime.now()
     values = [
-        (
-            row["release_id"],
-            row["version"],
-            row["extension_id"],
-            row["flags"],
-            row["last_updated"] if not pd.isna(row["last_updated"]) else None,
-        )
-        for _, row in releases_df.iterrows()
+        (*row, insertion_datetime)
+        for row in releases_df[columns[:-1]].itertuples(index=False, name=None)
     ]
 
     for i in range(0, len(values), batch_size):
         batch = values[i : i + batch_size]
-        upsert_data(logger, connection, "releases", upsert_query, values)
+        upsert_data(
+            logger, connection, "releases", columns, batch, conflict_column="release_id"
+        )
         logger.info(
             "upsert_releases: Upserted releases batch %d of %d rows",
             i // batch_size + 1,
@@ -206,4 +183,4 @@ def fetch_releases(logger: Logger):
     upsert_releases(logger, connection, releases_df)
 
     # Close
-    connection.close()
+    release_connection(connection)
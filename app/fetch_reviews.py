@@ -1,17 +1,22 @@
 """Fetches extension reviews from the VSCode Marketplace"""
 
 from logging import Logger
-import requests
+from datetime import datetime
+import orjson
 import pandas as pd
 import psycopg2
 
 from util import (
+    get_requests_session,
+    REQUESTS_TIMEOUT,
     upsert_data,
     clean_dataframe,
     connect_to_database,
+    release_connection,
     combine_dataframes,
     select_extensions,
     select_publishers,
+    map_marketplace_requests,
 )
 
 
@@ -22,15 +27,15 @@ def get_extension_reviews(
 ) -> list:
     """Fetches review metadata for a given extension from the VSCode Marketplace"""
 
-    response = requests.get(
+    response = get_requests_session().get(
         f"https://marketplace.visualstudio.com/_apis/public/gallery/"
         f"publishers/{publisher_name}/extensions/{extension_name}/reviews?count=100",
         headers={"accept": "application/json;api-version=7.2-preview.1;"},
-        timeout=5,
+        timeout=REQUESTS_TIMEOUT,
     )
 
     if response.status_code == 200:
-        reviews = response.json()["reviews"]
+        reviews = orjson.loads(response.content)["reviews"]
         logger.info(
             "get_extension_reviews: Fetched extension reviews for extension %s",
             extension_name,
@@ -49,20 +54,19 @@ def get_extension_reviews(
 def get_all_reviews(
     logger: Logger,
     combined_df: pd.DataFrame,
+    max_workers: int = 16,
 ) -> dict:
     """Fetches all review metadata from the VSCode Marketplace"""
 
-    all_reviews = {}
-
-    for _, row in combined_df.iterrows():
-        extension_id = row["extension_id"]
-        publisher_name = row["publisher_name"]
-        extension_name = row["extension_name"]
-
-        reviews = get_extension_reviews(logger, publisher_name, extension_name)
-        all_reviews[extension_id] = reviews
+    reviews = map_marketplace_requests(
+        logger,
+        get_extension_reviews,
+        combined_df["publisher_name"],
+        combined_df["extension_name"],
+        max_workers=max_workers,
+    )
 
-    return all_reviews
+    return dict(zip(combined_df["extension_id"], reviews))
 
 
 def extract_review_metadata(extension_reviews: dict) -> pd.DataFrame:
@@ -85,7 +89,19 @@ def extract_review_metadata(extension_reviews: dict) -> pd.DataFrame:
                 }
             )
 
-    return pd.DataFrame(review_metadata)
+    return pd.DataFrame(
+        review_metadata,
+        columns=[
+            "review_id",
+            "extension_id",
+            "user_id",
+            "user_display_name",
+            "updated_date",
+            "rating",
+            "text",
+            "product_version",
+        ],
+    )
 
 
 def upsert_reviews(
@@ -96,37 +112,29 @@ def upsert_reviews(
 ) -> None:
     """Upserts the given reviews to the database in batches"""
 
-    upsert_query = """
-        INSERT INTO reviews (
-            review_id, extension_id, user_id, user_display_name, updated_date, rating, text, product_version
-        ) VALUES %s
-        ON CONFLICT (review_id) DO UPDATE SET
-            extension_id = EXCLUDED.extension_id,
-            user_id = EXCLUDED.user_id,
-            user_display_name = EXCLUDED.user_display_name,
-            updated_date = EXCLUDED.updated_date,
-            rating = EXCLUDED.rating,
-            text = EXCLUDED.text,
-            product_version = EXCLUDED.product_version;
-    """
+    columns = [
+        "review_id",
+        "extension_id",
+        "user_id",
+        "user_display_name",
+        "updated_date",
+        "rating",
+        "text",
+        "product_version",
+        "insertion_datetime",
+    ]
 
+    insertion_datetime = datetime.now()
     values = [
-        (
-            row["review_id"],
-            row["extension_id"],
-            row["user_id"],
-            row["user_display_name"],
-            row["updated_date"],
-            row["rating"],
-            row["text"],
-            row["product_version"],
-        )
-        for _, row in reviews_df.iterrows()
+        (*row, insertion_datetime)
+        for row in reviews_df[columns[:-1]].itertuples(index=False, name=None)
     ]
 
     for i in range(0, len(values), batch_size):
         batch = values[i : i + batch_size]
-        upsert_data(logger, connection, "reviews", upsert_query, values)
+        upsert_data(
+            logger, connection, "reviews", columns, batch, conflict_column="review_id"
+        )
         logger.info(
             "upsert_reviews: Upserted reviews batch %d of %d rows",
             i // batch_size + 1,
@@ -156,4 +164,4 @@ def fetch_reviews(logger: Logger):
     upsert_reviews(logger, connection, reviews_df)
 
     # Close
-    connection.close()
+    release_connection(connection)
@@ -5,6 +5,7 @@ import json
 
 from util import (
     connect_to_database,
+    release_connection,
     select_extensions,
     select_publishers,
     select_latest_releases,
@@ -15,8 +16,7 @@ from fetch_extensions import (
     get_total_number_of_extensions,
     calculate_number_of_extension_pages,
     get_all_extensions,
-    extract_extension_metadata,
-    extract_publisher_metadata,
+    extract_metadata,
 )
 from fetch_releases import (
     get_all_releases,
@@ -50,13 +50,11 @@ def fetch_extensions_integration_test():
     print("\nThe first extension retrieved:")
     print(json.dumps(extensions[0], indent=4))
 
-    extensions_df, statistics_df = extract_extension_metadata(extensions)
+    extensions_df, statistics_df, publishers_df = extract_metadata(extensions)
     print("\nThe first five rows of the extension dataframe:")
     print(extensions_df.head())
     print("\nThe first five rows of the statistics dataframe:")
     print(statistics_df.head())
-
-    publishers_df = extract_publisher_metadata(extensions)
     print("\nThe first five rows of the publisher dataframe:")
     print(publishers_df.head())
 
@@ -94,7 +92,7 @@ def fetch_releases_integration_test():
     print("The first five rows of the cleaned releases_df:")
     print(releases_df.head())
 
-    connection.close()
+    release_connection(connection)
 
 
 def fetch_reviews_integration_test():
@@ -128,7 +126,7 @@ def fetch_reviews_integration_test():
     print("The first five rows of the cleaned reviews_df:")
     print(reviews_df.head())
 
-    connection.close()
+    release_connection(connection)
 
 
 def main() -> None:
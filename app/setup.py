@@ -5,7 +5,7 @@ import logging
 from logging import Logger
 import psycopg2
 
-from util import connect_to_database
+from util import connect_to_database, release_connection
 
 CREATE_EXTENSIONS_TABLE_QUERY = """
     CREATE TABLE IF NOT EXISTS extensions (
@@ -48,6 +48,8 @@ CREATE_RELEASES_TABLE_QUERY = """
         insertion_datetime TIMESTAMP NOT NULL,
         FOREIGN KEY (extension_id) REFERENCES extensions (extension_id) ON DELETE CASCADE
     );
+    CREATE INDEX IF NOT EXISTS idx_releases_latest
+        ON releases (extension_id, (string_to_array(version, '.')::int[]) DESC);
 """
 CREATE_REVIEWS_TABLE_QUERY = """
     CREATE TABLE IF NOT EXISTS reviews (
@@ -134,10 +136,11 @@ def setup_db(logger: Logger) -> bool:
         or not statistics
     ):
         logger.error("setup_db: Failed to create the tables")
-        connection.close()
+        release_connection(connection)
         return False
 
     logger.info("setup_db: Created the tables")
+    release_connection(connection)
     return True
 
 
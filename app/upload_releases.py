@@ -1,26 +1,48 @@
 """Downloads .vsix extension files from the VSCode marketplace and uploads them to S3"""
 
-import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from logging import Logger
-import tempfile
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
 from botocore.client import BaseClient
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 import requests
+import urllib3
 import psycopg2
+from psycopg2.extras import execute_values
 import pandas as pd
 
 from util import (
+    get_requests_session,
+    REQUESTS_TIMEOUT,
     connect_to_database,
-    combine_dataframes,
-    select_extensions,
-    select_publishers,
-    select_latest_releases,
+    release_connection,
+    select_pending_uploads,
+    get_s3_bucket_name,
 )
 
+# Read the marketplace response in large chunks so the S3 upload is not starved
+TRANSFER_CONFIG = TransferConfig(
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+    io_chunksize=1024 * 1024,
+)
+
+# Keep a pooled connection for every part the 16 upload workers can send at once
+# (16 * max_concurrency) and back off when S3 throttles
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    retries={"mode": "adaptive", "max_attempts": 5},
+)
+
+# Number of uploaded releases to mark in the database per UPDATE
+UPLOAD_STATUS_BATCH_SIZE = 500
+
 
 def upload_extension_to_s3(
     logger: Logger,
-    connection: psycopg2.extensions.connection,
     s3_client: BaseClient,
     extension_info: dict,
 ) -> bool:
@@ -29,102 +51,142 @@ def upload_extension_to_s3(
     publisher_name = extension_info["publisher_name"]
     extension_name = extension_info["extension_name"]
     extension_version = extension_info["extension_version"]
-    extension_id = extension_info["extension_id"]
 
-    response = requests.get(
-        f"https://marketplace.visualstudio.com/_apis/public/gallery/publishers/"
-        f"{publisher_name}/vsextensions/{extension_name}/{extension_version}/vspackage",
-        stream=True,
-        timeout=5,
-    )
+    try:
+        with get_requests_session().get(
+            f"https://marketplace.visualstudio.com/_apis/public/gallery/publishers/"
+            f"{publisher_name}/vsextensions/{extension_name}/{extension_version}/vspackage",
+            stream=True,
+            timeout=REQUESTS_TIMEOUT,
+        ) as response:
+            if response.status_code != 200:
+                logger.error(
+                    "upload_extension_to_s3: Error downloading extension %s version %s by "
+                    "publisher %s from marketplace: status code %d",
+                    extension_name,
+                    extension_version,
+                    publisher_name,
+                    response.status_code,
+                )
+                return False
+
+            bucket_name = get_s3_bucket_name()
+            s3_key = (
+                f"extensions/{publisher_name}/{extension_name}/{extension_version}.vsix"
+            )
 
-    if response.status_code == 200:
-        s3_key = (
-            f"extensions/{publisher_name}/{extension_name}/{extension_version}.vsix"
+            # Stream the .vsix file straight from the marketplace response to S3
+            response.raw.decode_content = True
+            s3_client.upload_fileobj(
+                response.raw,
+                bucket_name,
+                s3_key,
+                Config=TRANSFER_CONFIG,
+            )
+    except (
+        requests.RequestException,
+        urllib3.exceptions.HTTPError,
+        BotoCoreError,
+        ClientError,
+        S3UploadFailedError,
+    ) as error:
+        logger.error(
+            "upload_extension_to_s3: Error uploading extension %s version %s by "
+            "publisher %s to S3: %s",
+            extension_name,
+            extension_version,
+            publisher_name,
+            error,
         )
+        return False
+
+    logger.info(
+        "upload_extension_to_s3: Uploaded extension to S3: s3://%s/%s",
+        bucket_name,
+        s3_key,
+    )
 
-        # Use a temporary file to store the .vsix file
-        with tempfile.NamedTemporaryFile(delete=True) as temp_file:
-            # Write response content to the temporary file
-            for chunk in response.iter_content(chunk_size=8192):
-                temp_file.write(chunk)
+    return True
 
-            temp_file.seek(0)  # Rewind the file to the beginning
 
-            # Upload the temporary file to S3
-            s3_client.upload_file(temp_file.name, os.getenv("S3_BUCKET_NAME"), s3_key)
+def mark_uploaded_to_s3(
+    connection: psycopg2.extensions.connection,
+    releases: list,
+) -> None:
+    """Marks the given (extension_id, version) releases as uploaded to S3 in the database"""
 
-        logger.info(
-            "upload_extension_to_s3: Uploaded extension to S3: s3://%s/%s",
-            os.getenv("S3_BUCKET_NAME"),
-            s3_key,
-        )
+    if not releases:
+        return
 
-        update_query = f"""
-            UPDATE releases
-            SET uploaded_to_s3 = TRUE
-            WHERE extension_id = '{extension_id}' AND version = '{extension_version}';
-        """
-        cursor = connection.cursor()
-        cursor.execute(update_query)
-        connection.commit()
-        cursor.close()
-
-        return True
-
-    logger.error(
-        "upload_extension_to_s3: Error downloading extension %s version %s by publisher %s "
-        "from marketplace: status code %d",
-        extension_name,
-        extension_version,
-        publisher_name,
-        response.status_code,
-    )
-    return False
+    update_query = """
+        UPDATE releases
+        SET uploaded_to_s3 = TRUE
+        FROM (VALUES %s) AS uploaded (extension_id, version)
+        WHERE releases.extension_id = uploaded.extension_id
+            AND releases.version = uploaded.version;
+    """
+    cursor = connection.cursor()
+    execute_values(cursor, update_query, releases)
+    connection.commit()
+    cursor.close()
 
 
 def upload_all_extensions_to_s3(
     logger: Logger,
     connection: psycopg2.extensions.connection,
     s3_client: BaseClient,
-    combined_df: pd.DataFrame,
+    releases_df: pd.DataFrame,
+    max_workers: int = 16,
 ) -> None:
     """Fetches and uploads the given extensions to S3"""
 
-    for _, row in combined_df.iterrows():
-        extension_id = row["extension_id"]
-        extension_name = row["extension_name"]
-        publisher_name = row["publisher_name"]
-        extension_version = row["version"]
-        is_uploaded_to_s3 = row["uploaded_to_s3"]
-
-        # Check if extension version has already been uploaded to S3
-        if is_uploaded_to_s3:
-            logger.info(
-                "upload_all_extensions_to_s3: Skipped uploading version %s of extension %s "
-                "to S3 since it has already been uploaded",
-                extension_version,
-                extension_name,
-            )
-            continue
-
-        extension_info = {
-            "extension_id": extension_id,
-            "publisher_name": publisher_name,
-            "extension_name": extension_name,
-            "extension_version": extension_version,
+    rows = releases_df[
+        ["extension_id", "extension_name", "publisher_name", "version"]
+    ].itertuples(index=False, name=None)
+
+    # Downloads and uploads are I/O bound, so run them concurrently. The database
+    # connection is not shared with the workers; releases are marked as uploaded
+    # from this thread in batches as the workers finish.
+    uploaded_releases = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                upload_extension_to_s3,
+                logger,
+                s3_client,
+                {
+                    "publisher_name": publisher_name,
+                    "extension_name": extension_name,
+                    "extension_version": extension_version,
+                },
+            ): (extension_id, extension_name, publisher_name, extension_version)
+            for extension_id, extension_name, publisher_name, extension_version in rows
         }
 
-        success = upload_extension_to_s3(logger, connection, s3_client, extension_info)
-
-        if not success:
-            logger.error(
-                "upload_all_extensions_to_s3: Failed to upload extension %s version %s by %s "
-                "to S3",
-                extension_name,
-                extension_version,
-                publisher_name,
-            )
+        try:
+            for future in as_completed(futures):
+                extension_id, extension_name, publisher_name, extension_version = (
+                    futures[future]
+                )
+
+                if future.result():
+                    uploaded_releases.append((extension_id, extension_version))
+                    if len(uploaded_releases) >= UPLOAD_STATUS_BATCH_SIZE:
+                        mark_uploaded_to_s3(connection, uploaded_releases)
+                        uploaded_releases = []
+                else:
+                    logger.error(
+                        "upload_all_extensions_to_s3: Failed to upload extension %s "
+                        "version %s by %s to S3",
+                        extension_name,
+                        extension_version,
+                        publisher_name,
+                    )
+        finally:
+            # If anything failed, stop starting queued uploads and still record the
+            # releases that have been uploaded so far
+            executor.shutdown(wait=False, cancel_futures=True)
+            mark_uploaded_to_s3(connection, uploaded_releases)
 
 
 def upload_releases(logger: Logger):
@@ -132,21 +194,19 @@ def upload_releases(logger: Logger):
 
     # Setup
     connection = connect_to_database(logger)
-    s3_client = boto3.client("s3")
-
-    # Fetch the existing data from the database
-    extensions_df = select_extensions(logger, connection)
-    publishers_df = select_publishers(logger, connection)
-    releases_df = select_latest_releases(logger, connection)
-    extensions_publishers_releases_df = combine_dataframes(
-        [releases_df, extensions_df, publishers_df], ["extension_id", "publisher_id"]
+    s3_client = boto3.client("s3", config=S3_CLIENT_CONFIG)
+
+    # Fetch the releases still missing from S3. They are read in full before
+    # uploading since marking a release as uploaded commits on this connection.
+    releases_df = select_pending_uploads(logger, connection)
+    logger.info(
+        "upload_releases: Found %d extension versions to upload to S3",
+        len(releases_df),
     )
 
     # Fetch the extensions from the marketplace and upload them to S3
-    upload_all_extensions_to_s3(
-        logger, connection, s3_client, extensions_publishers_releases_df
-    )
+    upload_all_extensions_to_s3(logger, connection, s3_client, releases_df)
 
     # Close
-    connection.close()
+    release_connection(connection)
     s3_client.close()
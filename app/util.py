@@ -1,15 +1,33 @@
 """Contains helper functions"""
 
+import atexit
+import io
 import os
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Iterable, Iterator, List
 from logging import Logger
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import psycopg2
-from psycopg2.extras import execute_values
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
 import pandas as pd
 
+# Seconds to wait on the VSCode Marketplace before giving up on a request
+REQUESTS_TIMEOUT = 5
 
-def connect_to_database(logger: Logger) -> psycopg2.extensions.connection:
-    """Establishes a connection to the SQL database"""
+# Most requests per second sent to the VSCode Marketplace, shared by all crawl workers
+MARKETPLACE_REQUESTS_PER_SECOND = 4
+
+
+@lru_cache(maxsize=None)
+def get_database_config() -> dict:
+    """Reads the SQL database connection settings from the environment once"""
 
     use_ssl = os.getenv("SSL", "false").lower() == "true"
     ssl_config = (
@@ -21,43 +39,250 @@ def connect_to_database(logger: Logger) -> psycopg2.extensions.connection:
         else {}
     )
 
-    connection = psycopg2.connect(
-        dbname=os.getenv("PG_DATABASE"),
-        user=os.getenv("PG_USER"),
-        password=os.getenv("PG_PASSWORD"),
-        host=os.getenv("PG_HOST"),
-        port=os.getenv("PG_PORT"),
+    return {
+        "dbname": os.getenv("PG_DATABASE"),
+        "user": os.getenv("PG_USER"),
+        "password": os.getenv("PG_PASSWORD"),
+        "host": os.getenv("PG_HOST"),
+        "port": os.getenv("PG_PORT"),
         **ssl_config,
+    }
+
+
+@lru_cache(maxsize=None)
+def get_s3_bucket_name() -> str:
+    """Reads the name of the S3 bucket storing the extension files from the environment once"""
+
+    return os.getenv("S3_BUCKET_NAME")
+
+
+@lru_cache(maxsize=None)
+def get_connection_pool() -> ThreadedConnectionPool:
+    """Creates the pool of SQL database connections shared across the application"""
+
+    connection_pool = ThreadedConnectionPool(
+        minconn=1,
+        maxconn=int(os.getenv("PG_POOL_MAX", "8")),
+        **get_database_config(),
+    )
+    atexit.register(connection_pool.closeall)
+
+    return connection_pool
+
+
+@lru_cache(maxsize=None)
+def get_requests_session() -> requests.Session:
+    """Creates the HTTP session shared across the application to reuse connections"""
+
+    # The marketplace extension queries are read-only, so POSTs are safe to retry too
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET", "POST"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,  # Return the last response so callers can log it
+    )
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retries)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    atexit.register(session.close)
+
+    return session
+
+
+@lru_cache(maxsize=None)
+def get_marketplace_rate_lock() -> threading.Lock:
+    """Creates the lock that spaces out requests to the VSCode Marketplace once"""
+
+    return threading.Lock()
+
+
+def wait_for_marketplace_request() -> None:
+    """Blocks until another request may be sent to the VSCode Marketplace"""
+
+    # Only one worker holds the lock at a time and keeps it for the minimum spacing
+    # between requests, so requests start no faster than the shared rate however
+    # many workers are waiting
+    with get_marketplace_rate_lock():
+        time.sleep(1 / MARKETPLACE_REQUESTS_PER_SECOND)
+
+
+def map_marketplace_requests(
+    logger: Logger,
+    fetch: Callable,
+    *arguments: Iterable,
+    max_workers: int = 16,
+) -> list:
+    """Calls the given marketplace fetch function concurrently, returning its results in order"""
+
+    def paced_fetch(*fetch_arguments):
+        wait_for_marketplace_request()
+        return fetch(logger, *fetch_arguments)
+
+    # The requests are independent, so send them from several workers while the
+    # shared rate limit keeps the marketplace from being flooded
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(paced_fetch, *arguments))
+
+
+def query_extensions(payload: dict) -> requests.Response:
+    """Sends the given extension query to the VSCode Marketplace"""
+
+    return get_requests_session().post(
+        "https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery",
+        headers={
+            "accept": "application/json;api-version=7.2-preview.1;",
+            "content-type": "application/json",
+        },
+        data=orjson.dumps(payload),
+        timeout=REQUESTS_TIMEOUT,
     )
 
+
+def connect_to_database(logger: Logger) -> psycopg2.extensions.connection:
+    """Retrieves a connection to the SQL database from the connection pool"""
+
+    database_config = get_database_config()
+    connection = get_connection_pool().getconn()
+
     if connection:
         logger.info(
             "connect_to_database: Connected to database %s on host %s:%s",
-            os.getenv("PG_DATABASE"),
-            os.getenv("PG_HOST"),
-            os.getenv("PG_PORT"),
+            database_config["dbname"],
+            database_config["host"],
+            database_config["port"],
         )
         return connection
 
     logger.error(
         "connect_to_database: Failed to connect to database %s on host %s",
-        os.getenv("PG_DATABASE"),
-        os.getenv("PG_HOST"),
+        database_config["dbname"],
+        database_config["host"],
     )
     return None
 
 
-def upsert_data(
+def release_connection(connection: psycopg2.extensions.connection) -> None:
+    """Returns the given connection to the connection pool"""
+
+    get_connection_pool().putconn(connection)
+
+
+def select_with_connection(
+    logger: Logger,
+    select_function: Callable[[Logger, psycopg2.extensions.connection], pd.DataFrame],
+) -> pd.DataFrame:
+    """Runs the given select function on its own connection from the connection pool"""
+
+    connection = connect_to_database(logger)
+    try:
+        return select_function(logger, connection)
+    finally:
+        release_connection(connection)
+
+
+def format_copy_value(value) -> str:
+    """Formats the given value as a field of a COPY text format row"""
+
+    if pd.isna(value):
+        return "\\N"
+
+    # Integer columns reject "1.0", so whole-number floats are written as integers
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def upsert_data(  # pylint: disable=too-many-arguments
     logger: Logger,
     connection: psycopg2.extensions.connection,
     table_name: str,
-    upsert_data_query: str,
+    columns: List[str],
     data: list,
+    *,
+    conflict_column: str,
 ) -> None:
-    """Executes the upsert data query with the given data on the given table"""
+    """Copies the given data into a staging table and upserts it into the given table"""
+
+    if not data:
+        logger.info("upsert_data: No rows of %s data to upsert", table_name)
+        return
+
+    # A key can only be upserted once per statement, so duplicate keys in the data
+    # are collapsed
+    staging_table = sql.Identifier(f"staging_{table_name}")
+    column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+    update_list = sql.SQL(", ").join(
+        sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(column))
+        for column in columns
+        if column != conflict_column
+    )
+
+    # Only rewrite rows whose data changed; the insertion time alone is not a change
+    compared_columns = [
+        column
+        for column in columns
+        if column not in (conflict_column, "insertion_datetime")
+    ]
+    current_values = sql.SQL(", ").join(
+        sql.Identifier(table_name, column) for column in compared_columns
+    )
+    new_values = sql.SQL(", ").join(
+        sql.Identifier("excluded", column) for column in compared_columns
+    )
+
+    buffer = io.StringIO()
+    for row in data:
+        buffer.write("\t".join(format_copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
 
     cursor = connection.cursor()
-    execute_values(cursor, upsert_data_query, data)
+
+    # Skip waiting for the WAL flush on commit; a batch lost to a database crash is
+    # simply upserted again by the next run
+    cursor.execute("SET LOCAL synchronous_commit = off;")
+    cursor.execute(
+        sql.SQL(
+            "CREATE TEMP TABLE {staging_table} ON COMMIT DROP AS "
+            "SELECT {columns} FROM {table} WITH NO DATA;"
+        ).format(
+            staging_table=staging_table,
+            columns=column_list,
+            table=sql.Identifier(table_name),
+        )
+    )
+    cursor.copy_expert(
+        sql.SQL("COPY {staging_table} ({columns}) FROM STDIN;").format(
+            staging_table=staging_table, columns=column_list
+        ),
+        buffer,
+    )
+    cursor.execute(
+        sql.SQL(
+            "INSERT INTO {table} ({columns}) "
+            "SELECT DISTINCT ON ({conflict_column}) {columns} FROM {staging_table} "
+            "ON CONFLICT ({conflict_column}) DO UPDATE SET {updates} "
+            "WHERE ({current_values}) IS DISTINCT FROM ({new_values});"
+        ).format(
+            table=sql.Identifier(table_name),
+            columns=column_list,
+            staging_table=staging_table,
+            conflict_column=sql.Identifier(conflict_column),
+            updates=update_list,
+            current_values=current_values,
+            new_values=new_values,
+        )
+    )
     connection.commit()
     cursor.close()
 
@@ -68,6 +293,39 @@ def upsert_data(
     )
 
 
+def select_data_iter(
+    logger: Logger,
+    connection: psycopg2.extensions.connection,
+    table_name: str,
+    select_data_query: str,
+    chunk_size: int = 10000,
+) -> Iterator[pd.DataFrame]:
+    """Executes the select data query on the given table, yielding the results in chunks"""
+
+    # A named cursor makes the server stream the results instead of sending them all at once
+    with connection.cursor(name=f"select_{table_name}") as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(select_data_query)
+
+        num_chunks = 0
+        rows = cursor.fetchmany(chunk_size)
+        columns = [column.name for column in cursor.description]
+        while rows or num_chunks == 0:
+            chunk = pd.DataFrame(rows, columns=columns)
+            num_chunks += 1
+            logger.info(
+                "select_data_iter: Processed chunk of %s with %d rows",
+                table_name,
+                len(chunk),
+            )
+            yield chunk
+            rows = cursor.fetchmany(chunk_size)
+
+    # End the read transaction the named cursor opened, so the connection does not
+    # sit idle in transaction holding its snapshot and locks
+    connection.commit()
+
+
 def select_data(
     logger: Logger,
     connection: psycopg2.extensions.connection,
@@ -76,30 +334,41 @@ def select_data(
 ) -> pd.DataFrame:
     """Executes the select data query on the given table"""
 
-    chunks = []
-    for chunk in pd.read_sql_query(select_data_query, connection, chunksize=10000):
-        chunks.append(chunk)
-        logger.info(
-            "select_data: Processed chunk of %s with %d rows", table_name, len(chunk)
+    chunks = select_data_iter(logger, connection, table_name, select_data_query)
+    return pd.concat(list(chunks), ignore_index=True)
+
+
+def parse_datetime_columns(dataframe: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """Parses the given columns of ISO 8601 strings into UTC datetimes"""
+
+    for col in columns:
+        dataframe[col] = pd.to_datetime(
+            dataframe[col], format="ISO8601", utc=True, cache=True
         )
 
-    return pd.concat(chunks, ignore_index=True)
+    return dataframe
 
 
 def clean_dataframe(dataframe: pd.DataFrame) -> pd.DataFrame:
     """Prepares the given dataframe to be upserted to the database"""
 
+    datetime_columns = dataframe.select_dtypes(include=["datetime", "datetimetz"])
+    string_columns = dataframe.select_dtypes(include=["object", "string"])
+
     # Handling missing values in datetime columns by replacing NaT with None
-    for col in dataframe.select_dtypes(include=["datetime64[ns]"]):
-        dataframe[col] = dataframe[col].apply(lambda x: None if pd.isna(x) else x)
+    for col in datetime_columns:
+        dataframe[col] = (
+            dataframe[col].astype(object).where(dataframe[col].notna(), None)
+        )
 
     # Remove duplicate rows
     dataframe = dataframe.drop_duplicates()
 
-    # Strip leading and trailing spaces from string columns
-    for col in dataframe.select_dtypes(include=["object"]):
-        if isinstance(dataframe[col], str):
-            dataframe[col] = dataframe[col].str.strip()
+    # Strip leading and trailing spaces from string values, keeping any other values
+    for col in string_columns:
+        dataframe[col] = dataframe[col].map(
+            lambda value: value.strip() if isinstance(value, str) else value
+        )
 
     return dataframe
 
@@ -163,25 +432,45 @@ def select_latest_releases(
     """Retrieves the latest releases for each extension from the database"""
 
     query = """
-        WITH ranked_releases AS (
-            SELECT
-                extension_id,
-                version,
-                uploaded_to_s3,
-                ROW_NUMBER() OVER (
-                    PARTITION BY extension_id 
-                    ORDER BY
-                        string_to_array(version, '.')::int[] DESC
-                ) AS row_num
-            FROM releases
-        )
-        SELECT
+        SELECT DISTINCT ON (extension_id)
             extension_id,
             version,
             uploaded_to_s3
         FROM
-            ranked_releases
+            releases
+        ORDER BY
+            extension_id,
+            string_to_array(version, '.')::int[] DESC;
+    """
+    return select_data(logger, connection, "releases", query)
+
+
+def select_pending_uploads(
+    logger: Logger,
+    connection: psycopg2.extensions.connection,
+) -> pd.DataFrame:
+    """Retrieves the latest release of each extension that has not been uploaded to S3"""
+
+    query = """
+        SELECT
+            releases.extension_id,
+            extensions.extension_name,
+            publishers.publisher_name,
+            releases.version
+        FROM (
+            SELECT DISTINCT ON (extension_id)
+                extension_id,
+                version,
+                uploaded_to_s3
+            FROM
+                releases
+            ORDER BY
+                extension_id,
+                string_to_array(version, '.')::int[] DESC
+        ) AS releases
+        JOIN extensions ON extensions.extension_id = releases.extension_id
+        JOIN publishers ON publishers.publisher_id = extensions.publisher_id
         WHERE
-            row_num = 1;
+            NOT releases.uploaded_to_s3;
     """
     return select_data(logger, connection, "releases", query)
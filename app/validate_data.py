@@ -1,7 +1,8 @@
 """Checks the consistency of the data in the database and S3"""
 
-import os
+from concurrent.futures import ThreadPoolExecutor
 from logging import Logger
+from typing import Iterator
 from botocore.client import BaseClient
 import boto3
 import pandas as pd
@@ -9,10 +10,13 @@ import psycopg2
 
 from util import (
     connect_to_database,
-    select_data,
+    release_connection,
+    select_data_iter,
     combine_dataframes,
+    get_s3_bucket_name,
     select_extensions,
     select_publishers,
+    select_with_connection,
 )
 
 
@@ -20,47 +24,38 @@ def get_all_object_keys(s3_client: BaseClient) -> list:
     """Retrieves all object key names from the bucket"""
 
     paginator = s3_client.get_paginator("list_objects_v2")
+    page_iterator = paginator.paginate(Bucket=get_s3_bucket_name())
+
+    # Pages without any objects have no Contents, which the projection yields as None
     return [
-        s3_object["Key"]
-        for page in paginator.paginate(Bucket=os.getenv("S3_BUCKET_NAME"))
-        for s3_object in page["Contents"]
+        object_key
+        for object_key in page_iterator.search("Contents[].Key")
+        if object_key is not None
     ]
 
 
 def object_keys_to_dataframe(object_keys: list) -> pd.DataFrame:
     """Extracts the publisher name, extension name, and extension version from the S3 object keys"""
 
-    parsed_object_keys = []
-
-    for object_key in object_keys:
-        fields = object_key.split("/")
-        parsed_object_keys.append(
-            {
-                "publisher_name": fields[1],
-                "extension_name": fields[2],
-                "version": fields[3].replace(".vsix", ""),
-            }
-        )
-
-    return pd.DataFrame(parsed_object_keys)
-
+    if not object_keys:
+        return pd.DataFrame(columns=["publisher_name", "extension_name", "version"])
 
-def verified_uploaded_to_s3(
-    object_keys_df: pd.DataFrame, publisher_name: str, extension_name: str, version: str
-) -> bool:
-    """Checks if the status of given extension release in the dataframe is uploaded to S3"""
+    # Object keys have the format extensions/{publisher_name}/{extension_name}/{version}.vsix
+    fields = pd.Series(object_keys).str.split("/", n=3, expand=True)
 
-    return not object_keys_df.loc[
-        (object_keys_df["publisher_name"] == publisher_name)
-        & (object_keys_df["extension_name"] == extension_name)
-        & (object_keys_df["version"] == version)
-    ].empty
+    return pd.DataFrame(
+        {
+            "publisher_name": fields[1],
+            "extension_name": fields[2],
+            "version": fields[3].str.removesuffix(".vsix"),
+        }
+    )
 
 
 def select_releases(
     logger: Logger,
     connection: psycopg2.extensions.connection,
-) -> pd.DataFrame:
+) -> Iterator[pd.DataFrame]:
     """Retrieves all releases from the database in chunks"""
 
     query = """
@@ -71,7 +66,44 @@ def select_releases(
         FROM
             releases;
     """
-    return select_data(logger, connection, "releases", query)
+    return select_data_iter(logger, connection, "releases", query)
+
+
+def log_upload_mismatches(
+    logger: Logger,
+    releases_df: pd.DataFrame,
+    s3_releases_df: pd.DataFrame,
+) -> None:
+    """Logs the releases whose uploaded to S3 state in the database does not match S3"""
+
+    merged_df = releases_df.merge(
+        s3_releases_df, on=["publisher_name", "extension_name", "version"], how="left"
+    )
+    merged_df["s3_uploaded"] = merged_df["s3_uploaded"].fillna(False).astype(bool)
+    mismatched_df = merged_df[merged_df["uploaded_to_s3"] != merged_df["s3_uploaded"]]
+
+    if mismatched_df.empty:
+        return
+
+    mismatches = mismatched_df[
+        ["publisher_name", "extension_name", "version", "uploaded_to_s3", "s3_uploaded"]
+    ].itertuples(index=False, name=None)
+    for (
+        publisher_name,
+        extension_name,
+        extension_version,
+        db_uploaded_to_s3,
+        s3_uploaded_to_s3,
+    ) in mismatches:
+        logger.error(
+            "validate_data_consistency: Publisher %s, extension %s, version %s: "
+            "database state uploaded_to_s3: %s, while S3 state uploaded_to_s3: %s",
+            publisher_name,
+            extension_name,
+            extension_version,
+            db_uploaded_to_s3,
+            s3_uploaded_to_s3,
+        )
 
 
 def validate_data(
@@ -83,41 +115,30 @@ def validate_data(
     connection = connect_to_database(logger)
     s3_client = boto3.client("s3")
 
-    # Get the names of all objects stored in S3
-    object_keys = get_all_object_keys(s3_client)
-    object_keys_df = object_keys_to_dataframe(object_keys)
-
-    # Get all extension, publisher, and release data from the database
-    extensions_df = select_extensions(logger, connection)
-    publishers_df = select_publishers(logger, connection)
-    releases_df = select_releases(logger, connection)
-
-    extensions_publishers_releases_df = combine_dataframes(
-        [releases_df, extensions_df, publishers_df], ["extension_id", "publisher_id"]
-    )
+    # Get the names of all objects stored in S3 and all extension and publisher data
+    # from the database concurrently
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        object_keys_future = executor.submit(get_all_object_keys, s3_client)
+        extensions_future = executor.submit(
+            select_with_connection, logger, select_extensions
+        )
+        publishers_future = executor.submit(
+            select_with_connection, logger, select_publishers
+        )
 
-    for _, row in extensions_publishers_releases_df.iterrows():
-        publisher_name = row["publisher_name"]
-        extension_name = row["extension_name"]
-        extension_version = row["version"]
+    object_keys_df = object_keys_to_dataframe(object_keys_future.result())
+    s3_releases_df = object_keys_df.drop_duplicates().assign(s3_uploaded=True)
+    extensions_df = extensions_future.result()
+    publishers_df = publishers_future.result()
 
-        db_uploaded_to_s3 = row["uploaded_to_s3"]
-        s3_uploaded_to_s3 = verified_uploaded_to_s3(
-            object_keys_df, publisher_name, extension_name, extension_version
+    # Check if what exists in S3 matches the database state one chunk of releases at a time
+    for releases_df in select_releases(logger, connection):
+        extensions_publishers_releases_df = combine_dataframes(
+            [releases_df, extensions_df, publishers_df],
+            ["extension_id", "publisher_id"],
         )
-
-        # Check if what exists in S3 matches the database state
-        if db_uploaded_to_s3 != s3_uploaded_to_s3:
-            logger.error(
-                "validate_data_consistency: Publisher %s, extension %s, version %s: "
-                "database state uploaded_to_s3: %s, while S3 state uploaded_to_s3: %s",
-                publisher_name,
-                extension_name,
-                extension_version,
-                db_uploaded_to_s3,
-                s3_uploaded_to_s3,
-            )
+        log_upload_mismatches(logger, extensions_publishers_releases_df, s3_releases_df)
 
     # Close
-    connection.close()
+    release_connection(connection)
     s3_client.close()